@@ -3,11 +3,13 @@ from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from app.db.database import get_db
 from app.schema.response import APIResponse, PaginationMeta
-from app.schema.user import UserCreate, UserResponse, UserUpdate, UserPreferenceResponse, UserPreference, PasswordVerify, PasswordUpdate
+from app.schema.user import UserCreate, UserResponse, UserUpdate, UserPreferenceResponse, UserPreference, PasswordVerify, PasswordUpdate, BulkPushTokenUpdate, Segment, SegmentMember
 from app.services.user_service import UserService
 from app.core.security import create_access_token
 import sqlalchemy, redis
+import uuid
 from functools import wraps
+from typing import Optional
 import math
 
 router = APIRouter()
@@ -141,6 +143,39 @@ def update_user_push_token(user_id: str, token: UserUpdate, db: Session = Depend
         message="Push token updated successfully."
     )
     
+@router.put("/push-tokens/bulk", response_model=APIResponse)
+@handle_api_exceptions
+def bulk_update_push_tokens(bulk_update: BulkPushTokenUpdate, db: Session = Depends(get_db)):
+    result = UserService.bulk_update_push_tokens(db, bulk_update)
+    return APIResponse(
+        success=True,
+        data=result,
+        message="Push tokens updated successfully."
+    )
+    
+@router.get("/segments/{segment}", response_model=APIResponse)
+@handle_api_exceptions
+def get_segment_users(segment: Segment, db: Session = Depends(get_db), after: Optional[uuid.UUID] = Query(None), limit: int = Query(1000, ge=1, le=5000)):
+    rows, next_after = UserService.get_segment_page(db, segment, after, limit)
+    return APIResponse(
+        success=True,
+        data={
+            "users": [SegmentMember.model_validate(row) for row in rows],
+            "next_after": next_after
+        },
+        message="Segment users retrieved successfully."
+    )
+
+@router.get("/segments/{segment}/count", response_model=APIResponse)
+@handle_api_exceptions
+def get_segment_count(segment: Segment, db: Session = Depends(get_db), fresh: bool = Query(False)):
+    count = UserService.get_segment_count(db, segment, fresh)
+    return APIResponse(
+        success=True,
+        data={"segment": segment.value, "count": count},
+        message="Segment count retrieved successfully."
+    )
+
 @router.get("/preferences/{user_id}", response_model=APIResponse)
 @handle_api_exceptions
 def get_user_preferences(user_id: str, db: Session = Depends(get_db)):
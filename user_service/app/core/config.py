@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Optional, Dict
 
 
 class UserServiceSettings(BaseSettings):
@@ -15,6 +15,17 @@ class UserServiceSettings(BaseSettings):
     REDIS_PASSWORD: Optional[str] = None
     ALGORITHM: str = "HS256"
     SECRET_KEY: str
+    # optional shard map for users, JSON object of shard name -> database url
+    # e.g. {"shard_0": "postgresql://...", "shard_1": "postgresql://..."}, empty means no sharding
+    USER_SHARDS: Dict[str, str] = {}
+    USER_CACHE_TTL: int = 3600  # seconds a cached profile/preference lives in redis
+    USER_NEGATIVE_CACHE_TTL: int = 60  # seconds an unknown user id/email is remembered as missing
+    USER_CACHE_RECENT_MAX: int = 100000  # how many recently looked up user ids to remember for warm up
+    SEGMENT_COUNT_TTL: int = 600  # cached segment counts are recounted at least this often (seconds)
+    CACHE_WARM_ON_STARTUP: bool = False
+    CACHE_WARM_LIMIT: int = 10000  # most recent users to preload
+    CACHE_WARM_BATCH_SIZE: int = 500
+    CACHE_WARM_RATE: int = 2000  # max users loaded from postgres per second while warming
 
     class Config:
         env_file = ".env"
@@ -60,6 +60,66 @@ class RedisClient:
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
 
+    def set_many(self, values: dict, expire): #same as set but for many keys in one round trip
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, value in values.items():
+                pipe.set(key, json.dumps(value), expire)
+            pipe.execute()
+        except (TypeError, ValueError) as e:
+            print(f"Error setting values for {len(values)} keys: {e}")
+        except redis.RedisError as e:
+            print(f"Redis error occurred: {e}")
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+
+    def add_recent(self, key, member, score, max_size): #sorted set of members by last seen, trimmed to max_size
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.zadd(key, {member: score})
+            pipe.zremrangebyrank(key, 0, -(max_size + 1))
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Redis error occurred: {e}")
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+
+    def get_recent(self, key, count): #newest first
+        try:
+            return self.redis.zrevrange(key, 0, count - 1)
+        except redis.RedisError as e:
+            print(f"Redis error occurred: {e}")
+            return []
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+            return []
+
+    def set_unless_exists(self, key, value, expire, guard_key): #set key, but not while guard_key is present
+        try:
+            self.redis.eval(
+                "if redis.call('EXISTS', KEYS[2]) == 0 then redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2]) end",
+                2, key, guard_key, json.dumps(value), expire
+            )
+        except (TypeError, ValueError) as e:
+            print(f"Error setting value for key {key}: {e}")
+        except redis.RedisError as e:
+            print(f"Redis error occurred: {e}")
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+
+    def incr_if_exists(self, key, amount): #adjusts a cached counter, but never creates one from nothing
+        try:
+            return self.redis.eval(
+                "if redis.call('EXISTS', KEYS[1]) == 1 then return redis.call('INCRBY', KEYS[1], ARGV[1]) end return nil",
+                1, key, amount
+            )
+        except redis.RedisError as e:
+            print(f"Redis error occurred: {e}")
+            return None
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+            return None
+
     def delete(self, key): #this removes value from the redis cache
         try:
             self.redis.delete(key)
@@ -68,6 +128,17 @@ class RedisClient:
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
 
+    def delete_many(self, keys): #removes many keys in one round trip
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.delete(key)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Redis error occurred: {e}")
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+
     def ping(self): #put this to test redis conection
         try:
             return self.redis.ping()
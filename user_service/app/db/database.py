@@ -1,4 +1,6 @@
 from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
@@ -19,14 +21,39 @@ SessionLocal = sessionmaker(
 
 Base = declarative_base()
 
+def get_session():
+    if settings.USER_SHARDS:
+        from app.db.sharding import ShardedSessionLocal
+        return ShardedSessionLocal()
+    return SessionLocal()
+
 def get_db():
-    db = SessionLocal()
+    db = get_session()
     try:
         yield db
     finally:
         db.close()
 
+def create_tables(bind):
+    #autocommit, postgres only builds indexes marked postgresql_concurrently outside a transaction
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        Base.metadata.create_all(bind=connection)
+        #create_all skips indexes on tables that already exist, so add any new ones here
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+                except SQLAlchemyError as e:
+                    #e.g. another replica starting at the same time is building it, don't fail startup over it
+                    print(f"Could not create index {index.name}: {e}")
+
 def init_db():
     from app.models import user
-    Base.metadata.create_all(bind=engine)
+    if settings.USER_SHARDS:
+        from app.db.sharding import shard_router, directory_metadata
+        for shard_engine in shard_router.engines.values():
+            create_tables(shard_engine)
+        directory_metadata.create_all(bind=engine)
+    else:
+        create_tables(engine)
     print("tables created")
\ No newline at end of file
@@ -0,0 +1,219 @@
+import hashlib
+import heapq
+import uuid
+from itertools import islice
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, create_engine, delete, func, select
+from sqlalchemy.dialects.postgresql import UUID, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.horizontal_shard import ShardedSession, set_shard_id
+from sqlalchemy.orm import Session, selectinload, sessionmaker
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BindParameter, ColumnClause
+
+from app.core.config import settings
+from app.db.database import engine as directory_engine
+from app.models.user import User, UserPreferences
+
+# the email -> shard index lives on the main DATABASE_URL database, not on the shards,
+# so email lookups (login, get by email) know which shard to go to without asking all of them
+directory_metadata = MetaData()
+
+email_index = Table(
+    "user_email_index",
+    directory_metadata,
+    Column("email", String(255), primary_key=True),
+    Column("user_id", UUID(as_uuid=True), nullable=False, unique=True),
+    Column("shard_id", String(64), nullable=False, index=True),
+    Column("created_at", DateTime(timezone=True), default=func.now(), nullable=False),
+)
+
+
+def _to_uuid(value) -> uuid.UUID:
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+def _eq_comparisons(statement):
+    #collects (column, value) pairs for every "column = :value" in the where clause
+    #the operands are checked on the binary itself, traverse() reaches a binary before its children
+    comparisons = []
+
+    def visit_binary(binary):
+        if binary.operator is not operators.eq:
+            return
+        if isinstance(binary.left, ColumnClause) and isinstance(binary.right, BindParameter):
+            comparisons.append((binary.left, binary.right.effective_value))
+        elif isinstance(binary.right, ColumnClause) and isinstance(binary.left, BindParameter):
+            comparisons.append((binary.right, binary.left.effective_value))
+
+    whereclause = getattr(statement, "whereclause", None)
+    if whereclause is not None:
+        visitors.traverse(whereclause, {}, {"binary": visit_binary})
+    return comparisons
+
+
+class ShardRouter:
+
+    def __init__(self, shard_urls: Dict[str, str]):
+        self.engines = {
+            shard_id: create_engine(
+                url,
+                pool_pre_ping=True,
+                pool_size=10,
+                max_overflow=20,
+                echo=False
+            )
+            for shard_id, url in shard_urls.items()
+        }
+        self.shard_ids = sorted(self.engines)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.engines)
+
+    def shard_for(self, user_id) -> str:
+        #rendezvous hashing, adding or removing a shard only moves the users that hash to it
+        key = _to_uuid(user_id).bytes
+        return max(
+            self.shard_ids,
+            key=lambda shard_id: hashlib.blake2b(shard_id.encode() + key, digest_size=8).digest()
+        )
+
+    def group_by_shard(self, user_ids: Iterable) -> Dict[str, List[uuid.UUID]]:
+        grouped: Dict[str, List[uuid.UUID]] = {}
+        for user_id in user_ids:
+            user_uuid = _to_uuid(user_id)
+            grouped.setdefault(self.shard_for(user_uuid), []).append(user_uuid)
+        return grouped
+
+    # --- email index ---
+
+    def lookup_email(self, email: str) -> Optional[str]:
+        with directory_engine.connect() as connection:
+            return connection.execute(
+                select(email_index.c.shard_id).where(email_index.c.email == email)
+            ).scalar()
+
+    def reserve_email(self, email: str, user_id) -> bool:
+        #inserting the index row first doubles as a global unique check on email across shards
+        try:
+            with directory_engine.begin() as connection:
+                connection.execute(
+                    email_index.insert().values(
+                        email=email,
+                        user_id=_to_uuid(user_id),
+                        shard_id=self.shard_for(user_id)
+                    )
+                )
+            return True
+        except IntegrityError:
+            return False
+
+    def release_email(self, email: str):
+        with directory_engine.begin() as connection:
+            connection.execute(delete(email_index).where(email_index.c.email == email))
+
+    def index_emails(self, connection, rows):
+        #rows are (email, user_id, shard_id), upserted so it is safe to re-run
+        if not rows:
+            return
+        statement = insert(email_index).values(
+            [{"email": email, "user_id": user_id, "shard_id": shard_id} for email, user_id, shard_id in rows]
+        )
+        connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=[email_index.c.email],
+                set_={"user_id": statement.excluded.user_id, "shard_id": statement.excluded.shard_id}
+            )
+        )
+
+    # --- ShardedSession hooks ---
+
+    def shard_chooser(self, mapper, instance, clause=None):
+        if isinstance(instance, UserPreferences):
+            return self.shard_for(instance.user_id)
+        if instance.id is None:
+            instance.id = uuid.uuid4()
+        return self.shard_for(instance.id)
+
+    def identity_chooser(self, mapper, primary_key, *, lazy_loaded_from, **kw):
+        if lazy_loaded_from is not None:
+            return [lazy_loaded_from.identity_token]
+        if mapper.class_ is User:
+            return [self.shard_for(primary_key[0])]
+        #preference rows are keyed by their own id, so they can be on any shard
+        return self.shard_ids
+
+    def execute_chooser(self, orm_context):
+        if orm_context.lazy_loaded_from is not None:
+            return [orm_context.lazy_loaded_from.identity_token]
+
+        for column, value in _eq_comparisons(orm_context.statement):
+            if value is None:
+                continue
+            if column.shares_lineage(User.__table__.c.id) or column.shares_lineage(UserPreferences.__table__.c.user_id):
+                return [self.shard_for(value)]
+            if column.shares_lineage(User.__table__.c.email):
+                shard_id = self.lookup_email(value)
+                if shard_id:
+                    return [shard_id]
+
+        #nothing to route on (or an email missing from the index), ask every shard
+        return self.shard_ids
+
+    # --- scatter / gather reads ---
+
+    def get_users_page(self, db: Session, skip: int, limit: int):
+        #every shard returns its first skip+limit users in the same order, then we merge and slice
+        window = skip + limit
+        per_shard = [
+            db.query(User)
+            .options(set_shard_id(shard_id))
+            .order_by(User.created_at, User.id)
+            .limit(window)
+            .all()
+            for shard_id in self.shard_ids
+        ]
+        merged = heapq.merge(*per_shard, key=lambda user: (user.created_at, user.id))
+        users = list(islice(merged, skip, window))
+        total = self.count_users(db)
+        return users, total
+
+    def count_users(self, db: Session) -> int:
+        return sum(
+            db.query(func.count(User.id)).options(set_shard_id(shard_id)).scalar()
+            for shard_id in self.shard_ids
+        )
+
+    def merge_sorted(self, query, key, limit: int):
+        #query must already be ordered by key, each shard gives its first limit rows and we keep the overall first limit
+        per_shard = [query.options(set_shard_id(shard_id)).limit(limit).all() for shard_id in self.shard_ids]
+        return list(islice(heapq.merge(*per_shard, key=key), limit))
+
+    def sum_scalar(self, query) -> int:
+        return sum(query.options(set_shard_id(shard_id)).scalar() or 0 for shard_id in self.shard_ids)
+
+    def get_users_by_ids(self, db: Session, user_ids: Iterable) -> List[User]:
+        users = []
+        for shard_id, shard_user_ids in self.group_by_shard(user_ids).items():
+            users.extend(
+                db.query(User)
+                .options(set_shard_id(shard_id), selectinload(User.preferences))
+                .filter(User.id.in_(shard_user_ids))
+                .all()
+            )
+        return users
+
+
+shard_router = ShardRouter(settings.USER_SHARDS)
+
+ShardedSessionLocal = sessionmaker(
+    class_=ShardedSession,
+    autocommit=False,
+    autoflush=False,
+    shards=shard_router.engines,
+    shard_chooser=shard_router.shard_chooser,
+    identity_chooser=shard_router.identity_chooser,
+    execute_chooser=shard_router.execute_chooser,
+)
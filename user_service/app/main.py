@@ -4,7 +4,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from app.api.v1.router import api_router
 from app.core.config import settings
 from app.db.database import init_db
+from app.services.cache_warmer import warm_user_cache
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +18,10 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"atabase initialization failed: {e}")
         raise
+
+    if settings.CACHE_WARM_ON_STARTUP:
+        #runs in the background so the service can take traffic while the cache fills
+        threading.Thread(target=warm_user_cache, name="cache-warmer", daemon=True).start()
     
     yield
     logger.info("Service shutting down")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey, Index
 from app.db.database import Base
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -28,4 +28,11 @@ class UserPreferences(Base):
     updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now(), nullable=True)
     user = relationship("User", back_populates="preferences")
 
+# reverse lookup when fcm reports a token as dead, built concurrently since users is large by the time this lands
+Index("ix_users_push_token", User.push_token, postgresql_concurrently=True)
+
+# partial indexes for audience segments, only the opted-in rows are indexed, in user_id order for keyset paging
+Index("ix_user_preferences_push_enabled", UserPreferences.user_id, postgresql_where=UserPreferences.push.is_(True), postgresql_concurrently=True)
+Index("ix_user_preferences_email_enabled", UserPreferences.user_id, postgresql_where=UserPreferences.email.is_(True), postgresql_concurrently=True)
+
 
@@ -1,8 +1,23 @@
-from pydantic import BaseModel, EmailStr, field_validator
-from typing import Optional, Dict, Any
+from pydantic import BaseModel, EmailStr, Field, field_validator, model_validator
+from typing import Optional, Dict, Any, List
 from datetime import datetime
+from enum import Enum
 import uuid
 
+class Segment(str, Enum):
+    push = "push"  # push enabled and has a push token
+    email = "email"  # email enabled
+
+
+class SegmentMember(BaseModel):
+    user_id: uuid.UUID
+    email: EmailStr
+    push_token: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
 class UserPreference(BaseModel):
     email: bool = True
     push: bool = True
@@ -36,6 +51,23 @@ class UserCreate(BaseModel):
 class UserUpdate(BaseModel):
     push_token: Optional[str] = None
 
+
+class PushTokenChange(BaseModel):
+    #find the user by user_id or by the token they currently have, new_token null clears it
+    user_id: Optional[uuid.UUID] = None
+    old_token: Optional[str] = None
+    new_token: Optional[str] = None
+
+    @model_validator(mode='after')
+    def one_lookup_key(self):
+        if (self.user_id is None) == (self.old_token is None):
+            raise ValueError('Provide exactly one of user_id or old_token')
+        return self
+
+
+class BulkPushTokenUpdate(BaseModel):
+    updates: List[PushTokenChange] = Field(min_length=1, max_length=1000)
+
     
 class UserResponse(BaseModel):
     id: uuid.UUID
@@ -0,0 +1,139 @@
+#moves users to the shard their id hashes to under the current USER_SHARDS map and keeps the email index in step
+#run after adding/removing a shard:  python -m app.scripts.rebalance_shards [--dry-run] [--reindex] [--batch-size 500]
+#first move to shards from an unsharded database:  python -m app.scripts.rebalance_shards --from-url $DATABASE_URL
+#stop writes to the user service while this runs, users are copied then deleted, so a change made in between is lost
+import argparse
+
+from sqlalchemy import create_engine, delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from app.db.database import engine as directory_engine
+from app.db.sharding import shard_router
+from app.models.user import User, UserPreferences
+
+users_table = User.__table__
+preferences_table = UserPreferences.__table__
+
+
+def _iter_user_batches(shard_engine, batch_size):
+    #keyset pagination on id so rows we delete behind the cursor don't shift the pages
+    last_id = None
+    while True:
+        query = select(users_table.c.id, users_table.c.email).order_by(users_table.c.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(users_table.c.id > last_id)
+        with shard_engine.connect() as connection:
+            rows = connection.execute(query).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+def _copy_users(source_engine, target_id, user_ids):
+    target_engine = shard_router.engines[target_id]
+
+    with source_engine.connect() as connection:
+        users = connection.execute(select(users_table).where(users_table.c.id.in_(user_ids))).mappings().all()
+        preferences = connection.execute(
+            select(preferences_table).where(preferences_table.c.user_id.in_(user_ids))
+        ).mappings().all()
+
+    #rows already copied by an earlier interrupted run are skipped, any other conflict (e.g. a duplicate email) fails the batch
+    with target_engine.begin() as connection:
+        if users:
+            connection.execute(
+                insert(users_table).values([dict(row) for row in users])
+                .on_conflict_do_nothing(index_elements=[users_table.c.id])
+            )
+        if preferences:
+            connection.execute(
+                insert(preferences_table).values([dict(row) for row in preferences])
+                .on_conflict_do_nothing(index_elements=[preferences_table.c.id])
+            )
+
+    with directory_engine.begin() as connection:
+        shard_router.index_emails(connection, [(row["email"], row["id"], target_id) for row in users])
+
+
+def _move_users(source_id, target_id, user_ids):
+    source_engine = shard_router.engines[source_id]
+
+    #copy first, repoint the index, then delete, a crash in between leaves a duplicate that the next run cleans up
+    _copy_users(source_engine, target_id, user_ids)
+
+    with source_engine.begin() as connection:
+        #user_preferences rows go with it through ON DELETE CASCADE
+        connection.execute(delete(users_table).where(users_table.c.id.in_(user_ids)))
+
+
+def import_unsharded(source_url, batch_size=500, dry_run=False):
+    #copies the users/user_preferences tables of an unsharded database into the shards and fills the email index
+    #the source rows are left in place, drop them once the shards have been checked
+    source_engine = create_engine(source_url)
+    copied = 0
+    try:
+        for rows in _iter_user_batches(source_engine, batch_size):
+            for target_id, user_ids in shard_router.group_by_shard(row.id for row in rows).items():
+                if not dry_run:
+                    _copy_users(source_engine, target_id, user_ids)
+                copied += len(user_ids)
+            print(f"imported {copied} users{' (dry run)' if dry_run else ''}")
+    finally:
+        source_engine.dispose()
+
+    print(f"import done, copied {copied} users")
+    return copied
+
+
+def rebalance(batch_size=500, dry_run=False, reindex=False):
+    moved = 0
+    indexed = 0
+    for source_id in shard_router.shard_ids:
+        for rows in _iter_user_batches(shard_router.engines[source_id], batch_size):
+            to_move = {}
+            staying = []
+            for row in rows:
+                target_id = shard_router.shard_for(row.id)
+                if target_id == source_id:
+                    staying.append((row.email, row.id, source_id))
+                else:
+                    to_move.setdefault(target_id, []).append(row.id)
+
+            if reindex and not dry_run:
+                with directory_engine.begin() as connection:
+                    shard_router.index_emails(connection, staying)
+            indexed += len(staying)
+
+            for target_id, user_ids in to_move.items():
+                print(f"{source_id} -> {target_id}: {len(user_ids)} users{' (dry run)' if dry_run else ''}")
+                if not dry_run:
+                    _move_users(source_id, target_id, user_ids)
+                moved += len(user_ids)
+
+    print(f"rebalance done, moved {moved} users" + (f", reindexed {indexed} emails" if reindex else ""))
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebalance users across the shards in USER_SHARDS. Stop writes to the user service while it runs."
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="only report what would move")
+    parser.add_argument("--reindex", action="store_true", help="also rebuild the email index for users that stay put")
+    parser.add_argument("--from-url", help="copy users from this unsharded database (usually DATABASE_URL) into the shards first")
+    args = parser.parse_args()
+
+    if not shard_router.enabled:
+        parser.error("USER_SHARDS is not set, nothing to rebalance")
+
+    from app.db.database import init_db
+    init_db()
+    if args.from_url:
+        import_unsharded(args.from_url, batch_size=args.batch_size, dry_run=args.dry_run)
+    rebalance(batch_size=args.batch_size, dry_run=args.dry_run, reindex=args.reindex)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+#preloads user profiles and preferences into redis, run after a deploy, a redis failover or a cache key change
+#python -m app.scripts.warm_cache                      most recently looked up users
+#python -m app.scripts.warm_cache --ids-file ids.txt   one user id per line
+import argparse
+
+from app.services.cache_warmer import warm_user_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preload user profiles and preferences into Redis")
+    parser.add_argument("--ids-file", help="file with one user id per line, defaults to the recently looked up users")
+    parser.add_argument("--limit", type=int, default=None, help="max users to preload")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--rate", type=int, default=None, help="max users per second read from postgres, 0 for no limit")
+    args = parser.parse_args()
+
+    user_ids = None
+    if args.ids_file:
+        with open(args.ids_file) as ids_file:
+            user_ids = [line.strip() for line in ids_file if line.strip()]
+
+    warm_user_cache(user_ids=user_ids, limit=args.limit, batch_size=args.batch_size, rate=args.rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import time
+import uuid
+from typing import Optional
+
+from app.core.config import settings
+from app.core.redis import redis_client
+from app.db.database import get_session
+from app.services.user_service import UserService, RECENT_USERS_KEY
+
+
+def warm_user_cache(user_ids: Optional[list] = None, limit: Optional[int] = None, batch_size: Optional[int] = None, rate: Optional[int] = None):
+    #preloads profiles and preferences into redis so the first requests after a deploy or redis restart don't all hit postgres
+    #user_ids defaults to the most recently looked up users, rate is users per second read from postgres (0 = no limit)
+    limit = settings.CACHE_WARM_LIMIT if limit is None else limit
+    batch_size = batch_size or settings.CACHE_WARM_BATCH_SIZE
+    rate = settings.CACHE_WARM_RATE if rate is None else rate
+
+    if user_ids is None:
+        user_ids = redis_client.get_recent(RECENT_USERS_KEY, limit)
+    else:
+        user_ids = list(user_ids)[:limit]
+
+    valid_ids = []
+    for user_id in user_ids:
+        try:
+            valid_ids.append(uuid.UUID(str(user_id)))
+        except ValueError:
+            print(f"Cache warm up: skipping invalid user id {user_id}")
+    user_ids = valid_ids
+
+    if not user_ids:
+        print("Cache warm up: no users to preload")
+        return 0
+
+    warmed = 0
+    started = time.monotonic()
+    db = get_session()
+    try:
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            users = UserService.get_users_by_ids(db, batch)
+            warmed += UserService.cache_users(users)
+            #drop the loaded rows so a long run doesn't keep every user in the session
+            db.expunge_all()
+
+            if rate:
+                #sleep until we are back under the rate, so the primary only sees rate users/sec from us
+                ahead = (start + len(batch)) / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+    finally:
+        db.close()
+
+    print(f"Cache warm up: preloaded {warmed} of {len(user_ids)} users in {time.monotonic() - started:.1f}s")
+    return warmed
@@ -1,39 +1,149 @@
 from fastapi import HTTPException, status
-from sqlalchemy.orm import Session
-from app.schema.user import UserCreate, UserUpdate, UserPreference, PasswordUpdate, PasswordVerify
+from sqlalchemy import case, func, update
+from sqlalchemy.orm import Session, selectinload
+from app.schema.user import UserCreate, UserUpdate, UserPreference, PasswordUpdate, PasswordVerify, UserResponse, UserPreferenceResponse, BulkPushTokenUpdate, Segment
 from app.models.user import User, UserPreferences
 from app.core.security import hash_password, verify_password
 from app.core.redis import redis_client
+from app.core.config import settings
+from app.db.sharding import shard_router
+import time
+import uuid
+
+RECENT_USERS_KEY = "user:recent"  # sorted set of user ids scored by last lookup, used to pick users for cache warm up
+
+
+def normalize_user_id(user_id):
+    #one spelling per user in every key, a path id can come in upper case or without dashes
+    return str(uuid.UUID(str(user_id)))
+
+def user_cache_key(user_id):
+    return f"user:profile:{normalize_user_id(user_id)}"
+
+def user_preference_cache_key(user_id):
+    return f"user_preference:{normalize_user_id(user_id)}"
+
+#negative entries, set when a lookup finds nothing so retries with the same bad id/email don't reach postgres
+def missing_user_cache_key(user_id):
+    return f"user:missing:id:{normalize_user_id(user_id)}"
+
+def missing_email_cache_key(email):
+    return f"user:missing:email:{email}"
+
+#set by create_user next to each missing key it clears, a lookup that missed before the create can't re-add it
+def created_marker_key(missing_key):
+    return missing_key.replace("user:missing:", "user:created:", 1)
+
+def segment_count_cache_key(segment):
+    return f"segment:count:{segment}"
+
+#who is in each audience segment, the preference filters line up with the partial indexes on user_preferences
+SEGMENT_FILTERS = {
+    Segment.push: [UserPreferences.push.is_(True), User.push_token.isnot(None)],
+    Segment.email: [UserPreferences.email.is_(True)],
+}
+
+def segments_for(email_enabled, push_enabled, push_token):
+    segments = set()
+    if push_enabled and push_token is not None:
+        segments.add(Segment.push)
+    if email_enabled:
+        segments.add(Segment.email)
+    return segments
 
 
 class UserService:
 
     @staticmethod
     def _cache_user_preference(user_preference: UserPreferences):
-        cache_pref_data = {
-            "id": str(user_preference.user_id),
-            "email": user_preference.email,
-            "push": user_preference.push
-        }
-        
-        redis_client.set(f"user:id:{user_preference.user_id}", cache_pref_data, expire=3600)
+        #stored in the same shape as the api response so a cache hit can be returned as is
+        cache_pref_data = UserPreferenceResponse.model_validate(user_preference).model_dump(mode="json")
+        redis_client.set(user_preference_cache_key(user_preference.user_id), cache_pref_data, expire=settings.USER_CACHE_TTL)
+
+    @staticmethod
+    def _cache_user(user: User):
+        cache_user_data = UserResponse.model_validate(user).model_dump(mode="json")
+        redis_client.set(user_cache_key(user.id), cache_user_data, expire=settings.USER_CACHE_TTL)
+
+    @staticmethod
+    def _invalidate_user_cache(user_id):
+        redis_client.delete(user_cache_key(user_id))
+        redis_client.delete(user_preference_cache_key(user_id))
+
+    @staticmethod
+    def _cache_missing(key):
+        redis_client.set_unless_exists(key, True, settings.USER_NEGATIVE_CACHE_TTL, guard_key=created_marker_key(key))
+
+    @staticmethod
+    def _clear_missing(key):
+        #marker first, so a lookup racing with us either gets its entry deleted here or is refused by the marker
+        redis_client.set(created_marker_key(key), True, expire=settings.USER_NEGATIVE_CACHE_TTL)
+        redis_client.delete(key)
+
+    @staticmethod
+    def _adjust_segment_counts(before: set, after: set):
+        #keeps cached segment counts in step with a single user's change, missing counts are left for the next recount
+        for segment in after - before:
+            redis_client.incr_if_exists(segment_count_cache_key(segment.value), 1)
+        for segment in before - after:
+            redis_client.incr_if_exists(segment_count_cache_key(segment.value), -1)
+
+    @staticmethod
+    def _mark_recent(user_id):
+        redis_client.add_recent(RECENT_USERS_KEY, normalize_user_id(user_id), time.time(), settings.USER_CACHE_RECENT_MAX)
+
+    @staticmethod
+    def cache_users(users: list): #writes profiles and preferences for many users in one pipelined round trip, returns how many were cached
+        values = {}
+        cached = 0
+        for user in users:
+            #a user whose preferences row was never written can't be shaped as a UserResponse, leave it to the normal lookup
+            if user.preferences is None:
+                print(f"Skipping cache for user {user.id}, no preferences found")
+                continue
+            values[user_cache_key(user.id)] = UserResponse.model_validate(user).model_dump(mode="json")
+            values[user_preference_cache_key(user.id)] = UserPreferenceResponse.model_validate(user.preferences).model_dump(mode="json")
+            cached += 1
+        if values:
+            redis_client.set_many(values, expire=settings.USER_CACHE_TTL)
+        return cached
 
     @staticmethod
     def create_user(db: Session, user: UserCreate): #creates user and user preferences in the main database
-        exist_user = db.query(User).filter(User.email == user.email).first()
-        if exist_user:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User with this email already exists.")
+        #with sharding the email index is the unique check (reserve_email below), a new email isn't in it
+        #so this query would go to every shard for nothing
+        if not shard_router.enabled:
+            exist_user = db.query(User).filter(User.email == user.email).first()
+            if exist_user:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User with this email already exists.")
         hashed_password = hash_password(user.password)
         new_user = User(
+            id = uuid.uuid4(),
             name = user.name,
             email = user.email,
             password = hashed_password,
             push_token = user.push_token
         )
-        db.add(new_user)
-        db.commit()
+
+        if shard_router.enabled:
+            if not shard_router.reserve_email(new_user.email, new_user.id):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User with this email already exists.")
+            try:
+                db.add(new_user)
+                db.commit()
+            except Exception:
+                db.rollback()
+                shard_router.release_email(new_user.email)
+                raise
+        else:
+            db.add(new_user)
+            db.commit()
         db.refresh(new_user)
 
+        #the email (or id) may have been looked up and cached as missing before it existed
+        UserService._clear_missing(missing_email_cache_key(new_user.email))
+        UserService._clear_missing(missing_user_cache_key(new_user.id))
+
         user_preference = UserPreferences(
             user_id = new_user.id,
             email = user.preferences.email,
@@ -44,30 +154,57 @@ class UserService:
         db.refresh(user_preference)
         
         UserService._cache_user_preference(user_preference)
+        UserService._adjust_segment_counts(set(), segments_for(user_preference.email, user_preference.push, new_user.push_token))
 
         return new_user
     
     @staticmethod
     def get_user_by_id(db: Session, user_id: str):
+        user_id = uuid.UUID(str(user_id))
+        cached_user = redis_client.get(user_cache_key(user_id))
+        if cached_user:
+            UserService._mark_recent(user_id)
+            return cached_user
+
+        if redis_client.get(missing_user_cache_key(user_id)):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User {user_id} not found.")
+
         user = db.query(User).filter(User.id == user_id).first() 
         if not user:
+            UserService._cache_missing(missing_user_cache_key(user_id))
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User {user_id} not found.")
+        UserService._cache_user(user)
+        UserService._mark_recent(user_id)
         return user
     
+    @staticmethod
+    def get_users_by_ids(db: Session, user_ids: list): #batch lookup, ids that don't exist are just left out
+        if not user_ids:
+            return []
+        if shard_router.enabled:
+            return shard_router.get_users_by_ids(db, user_ids)
+        user_ids = [uuid.UUID(str(user_id)) for user_id in user_ids]
+        return db.query(User).options(selectinload(User.preferences)).filter(User.id.in_(user_ids)).all()
+
     @staticmethod
     def get_user_by_email(db: Session, user_email: str):
+        if redis_client.get(missing_email_cache_key(user_email)):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found.")
+
         user = db.query(User).filter(User.email == user_email).first()
         if not user:
+            UserService._cache_missing(missing_email_cache_key(user_email))
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User not found.")
         return user
     
     @staticmethod
     def get_user_preference(db: Session, user_id: str):
-        cache_key  = f"user_preference:{user_id}"
-        cached_preference = redis_client.get(cache_key)
+        user_id = uuid.UUID(str(user_id))
+        cached_preference = redis_client.get(user_preference_cache_key(user_id))
 
         if cached_preference:
             print(f"User preferences for {user_id} fetched from cache")
+            UserService._mark_recent(user_id)
             return cached_preference
         
         print(f"User preferences for {user_id} not found in cache, fetching from database")
@@ -77,14 +214,19 @@ class UserService:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Preference for user {user_id} not found.")
         
         UserService._cache_user_preference(preference)
+        UserService._mark_recent(user_id)
         return preference
     
     @staticmethod
     def update_push_token(db: Session, user_id: str, token: UserUpdate):
+        user_id = uuid.UUID(str(user_id))
         user = db.query(User).filter(User.id == user_id).first()
         if not user:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User {user_id} not found.")
         
+        preference = user.preferences
+        before = segments_for(preference.email, preference.push, user.push_token) if preference else set()
+
         if token.push_token is not None:
             user.push_token = token.push_token
         else:
@@ -93,22 +235,83 @@ class UserService:
         db.commit()
         db.refresh(user)
 
+        redis_client.delete(user_cache_key(user_id))
+        if preference:
+            UserService._adjust_segment_counts(before, segments_for(preference.email, preference.push, user.push_token))
+
         return user
     
+    @staticmethod
+    def bulk_update_push_tokens(db: Session, bulk: BulkPushTokenUpdate):
+        #applies many token changes as one UPDATE ... SET push_token = CASE ... per lookup kind instead of a query per user
+        #changes by user_id are applied before changes by old_token, a repeated key keeps its last value
+        by_id = {}
+        by_token = {}
+        for change in bulk.updates:
+            if change.user_id is not None:
+                by_id[change.user_id] = change.new_token
+            else:
+                by_token[change.old_token] = change.new_token
+
+        updated_ids = set()
+        for shard_id in (shard_router.shard_ids if shard_router.enabled else [None]):
+            bind_arguments = {"shard_id": shard_id} if shard_id else None
+
+            shard_by_id = {
+                user_id: token for user_id, token in by_id.items()
+                if shard_id is None or shard_router.shard_for(user_id) == shard_id
+            }
+            if shard_by_id:
+                result = db.execute(
+                    update(User)
+                    .where(User.id.in_(list(shard_by_id)))
+                    .values(push_token=case(shard_by_id, value=User.id))
+                    .returning(User.id)
+                    .execution_options(synchronize_session=False),
+                    bind_arguments=bind_arguments
+                )
+                updated_ids.update(result.scalars().all())
+
+            #any shard can hold a given token, so this one goes to all of them
+            if by_token:
+                result = db.execute(
+                    update(User)
+                    .where(User.push_token.in_(list(by_token)))
+                    .values(push_token=case(by_token, value=User.push_token))
+                    .returning(User.id)
+                    .execution_options(synchronize_session=False),
+                    bind_arguments=bind_arguments
+                )
+                updated_ids.update(result.scalars().all())
+
+        db.commit()
+
+        redis_client.delete_many([user_cache_key(user_id) for user_id in updated_ids])
+        #we don't know who had a token before, so recount the push segment next time it is asked for
+        if updated_ids:
+            redis_client.delete(segment_count_cache_key(Segment.push.value))
+
+        return {"requested": len(bulk.updates), "updated": len(updated_ids)}
+
     @staticmethod
     def update_user_preference(db: Session, user_id: str, preference: UserPreference):
+        user_id = uuid.UUID(str(user_id))
         user_preference = db.query(UserPreferences).filter(UserPreferences.user_id == user_id).first()
         if not user_preference:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Preference for user {user_id} not found.")
         
+        push_token = user_preference.user.push_token
+        before = segments_for(user_preference.email, user_preference.push, push_token)
+
         user_preference.email = preference.email
         user_preference.push = preference.push
 
         db.commit()
         db.refresh(user_preference)
 
-        redis_client.delete(f"user:preference:{user_id}")
+        redis_client.delete(user_cache_key(user_id))
         UserService._cache_user_preference(user_preference)
+        UserService._adjust_segment_counts(before, segments_for(user_preference.email, user_preference.push, push_token))
 
         return user_preference
     
@@ -125,6 +328,7 @@ class UserService:
     
     @staticmethod
     def update_user_password(db: Session, user_id: str, password: PasswordUpdate):
+        user_id = uuid.UUID(str(user_id))
         user = db.query(User).filter(User.id == user_id).first()
         if not user:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User {user_id} not found.")
@@ -136,26 +340,84 @@ class UserService:
         db.commit()
         db.refresh(user)
 
+        redis_client.delete(user_cache_key(user_id))
+
         return user
     
     @staticmethod
     def get_all_users(db: Session, page: int, limit: int):
         skip = (page - 1) * limit
+        if shard_router.enabled:
+            return shard_router.get_users_page(db, skip, limit)
         users = db.query(User).offset(skip).limit(limit).all()
         total = db.query(User).count()
         return users, total
     
+    @staticmethod
+    def _segment_query(db: Session, segment: Segment, *columns):
+        return (
+            db.query(*columns)
+            .select_from(UserPreferences)
+            .join(User, User.id == UserPreferences.user_id)
+            .filter(*SEGMENT_FILTERS[segment])
+        )
+
+    @staticmethod
+    def get_segment_page(db: Session, segment: Segment, after: uuid.UUID = None, limit: int = 1000):
+        #keyset paging on user_id, pass the returned next_after back as after until it comes back empty
+        query = UserService._segment_query(db, segment, UserPreferences.user_id, User.email, User.push_token)
+        if after is not None:
+            query = query.filter(UserPreferences.user_id > after)
+        query = query.order_by(UserPreferences.user_id)
+
+        if shard_router.enabled:
+            rows = shard_router.merge_sorted(query, key=lambda row: row.user_id, limit=limit)
+        else:
+            rows = query.limit(limit).all()
+
+        next_after = rows[-1].user_id if len(rows) == limit else None
+        return rows, next_after
+
+    @staticmethod
+    def get_segment_count(db: Session, segment: Segment, fresh: bool = False):
+        cache_key = segment_count_cache_key(segment.value)
+        if not fresh:
+            cached_count = redis_client.get(cache_key)
+            if cached_count is not None:
+                return cached_count
+
+        query = UserService._segment_query(db, segment, func.count(UserPreferences.user_id))
+        if shard_router.enabled:
+            count = shard_router.sum_scalar(query)
+        else:
+            count = query.scalar()
+
+        redis_client.set(cache_key, count, expire=settings.SEGMENT_COUNT_TTL)
+        return count
+
     @staticmethod
     def delete_user(db:Session, user_id: str):
+        user_id = uuid.UUID(str(user_id))
         user = db.query(User).filter(User.id == user_id).first()
         if not user:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User {user_id} not found.")
         
+        email = user.email
+        preference = user.preferences
+        segments = segments_for(preference.email, preference.push, user.push_token) if preference else set()
+
         db.delete(user)
         db.commit()
 
-        cache_key = f"user:preference:{user_id}"
-        redis_client.delete(cache_key)
+        if shard_router.enabled:
+            shard_router.release_email(email)
+
+        UserService._invalidate_user_cache(user_id)
+        #callers holding the old id keep retrying it for a while, answer those from the cache
+        for missing_key in (missing_user_cache_key(user_id), missing_email_cache_key(email)):
+            redis_client.delete(created_marker_key(missing_key))
+            UserService._cache_missing(missing_key)
+        UserService._adjust_segment_counts(segments, set())
 
         return True
 
@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# settings are read when app modules are imported, so point them at throwaway local resources first
+_test_dir = tempfile.mkdtemp(prefix="user_service_tests_")
+os.environ.setdefault("PORT", "8081")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_test_dir}/users.db")
+os.environ.setdefault("REDIS_URL", "redis://127.0.0.1:1")
+os.environ.setdefault("SECRET_KEY", "test-secret")
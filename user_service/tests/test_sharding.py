@@ -0,0 +1,65 @@
+import uuid
+
+import pytest
+
+from app.db.sharding import ShardRouter, _eq_comparisons
+from app.db.database import get_session
+from app.models.user import User, UserPreferences
+
+
+class FakeExecuteState:
+    def __init__(self, statement):
+        self.statement = statement
+        self.lazy_loaded_from = None
+
+
+@pytest.fixture
+def router(tmp_path):
+    return ShardRouter({f"shard_{i}": f"sqlite:///{tmp_path}/shard_{i}.db" for i in range(3)})
+
+
+def test_eq_comparisons_finds_column_and_value():
+    user_id = uuid.uuid4()
+    db = get_session()
+    statement = db.query(User).filter(User.id == user_id).statement
+
+    comparisons = _eq_comparisons(statement)
+
+    assert len(comparisons) == 1
+    column, value = comparisons[0]
+    assert column.shares_lineage(User.__table__.c.id)
+    assert value == user_id
+
+
+def test_id_filter_routes_to_one_shard(router):
+    user_id = uuid.uuid4()
+    db = get_session()
+
+    for statement in (
+        db.query(User).filter(User.id == user_id).statement,
+        db.query(User).filter(User.id == str(user_id)).statement,
+        db.query(UserPreferences).filter(UserPreferences.user_id == user_id).statement,
+    ):
+        assert router.execute_chooser(FakeExecuteState(statement)) == [router.shard_for(user_id)]
+
+
+def test_email_filter_routes_through_index(router, monkeypatch):
+    looked_up = []
+
+    def lookup_email(email):
+        looked_up.append(email)
+        return "shard_1"
+
+    monkeypatch.setattr(router, "lookup_email", lookup_email)
+    statement = get_session().query(User).filter(User.email == "a@b.c").statement
+
+    assert router.execute_chooser(FakeExecuteState(statement)) == ["shard_1"]
+    assert looked_up == ["a@b.c"]
+
+
+def test_unindexed_email_and_unfiltered_queries_go_to_every_shard(router, monkeypatch):
+    monkeypatch.setattr(router, "lookup_email", lambda email: None)
+    db = get_session()
+
+    assert router.execute_chooser(FakeExecuteState(db.query(User).filter(User.email == "x@y.z").statement)) == router.shard_ids
+    assert router.execute_chooser(FakeExecuteState(db.query(User).statement)) == router.shard_ids
@@ -0,0 +1,195 @@
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # fakeredis only runs EVAL scripts with lupa installed
+
+from app.core.redis import redis_client
+from app.db.database import get_session, init_db
+from app.schema.user import UserCreate, UserPreference, UserResponse, UserUpdate
+from app.services.user_service import (
+    RECENT_USERS_KEY,
+    UserService,
+    missing_email_cache_key,
+    missing_user_cache_key,
+    user_cache_key,
+)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(redis_client, "redis", fakeredis.FakeRedis(decode_responses=True))
+    init_db()
+    session = get_session()
+    yield session
+    session.close()
+
+
+def create_user(db, email, push_token=None):
+    return UserService.create_user(db, UserCreate(
+        name="Test",
+        email=email,
+        password="password123",
+        push_token=push_token,
+        preferences=UserPreference()
+    ))
+
+
+def test_non_canonical_id_shares_the_cache_entry(db):
+    user = create_user(db, f"{uuid.uuid4()}@example.com", push_token="old")
+    canonical = str(user.id)
+    upper = canonical.upper()
+
+    UserService.get_user_by_id(db, canonical)
+    assert redis_client.get(user_cache_key(upper)) is not None
+
+    UserService.update_push_token(db, upper, UserUpdate(push_token="new"))
+    assert redis_client.get(user_cache_key(canonical)) is None
+
+    assert UserResponse.model_validate(UserService.get_user_by_id(db, canonical)).push_token == "new"
+    UserService.get_user_by_id(db, upper)
+    assert redis_client.redis.zrange(RECENT_USERS_KEY, 0, -1) == [canonical]
+
+
+def test_warm_up_skips_users_without_preferences(db):
+    from app.models.user import User
+    from app.services.cache_warmer import warm_user_cache
+
+    user = create_user(db, f"{uuid.uuid4()}@example.com")
+    orphan = User(id=uuid.uuid4(), name="Orphan", email=f"{uuid.uuid4()}@example.com", password="x")
+    db.add(orphan)
+    db.commit()
+    redis_client.redis.flushall()
+
+    assert warm_user_cache(user_ids=[str(orphan.id), str(user.id)], rate=0) == 1
+
+    assert redis_client.get(user_cache_key(user.id)) is not None
+    assert redis_client.get(user_cache_key(orphan.id)) is None
+
+
+def lookup_email(db, email):
+    try:
+        return UserService.get_user_by_email(db, email)
+    except HTTPException as e:
+        assert e.status_code == 404
+        return None
+
+
+def test_missing_email_is_cached_until_created(db):
+    email = f"{uuid.uuid4()}@example.com"
+
+    assert lookup_email(db, email) is None
+    assert redis_client.get(missing_email_cache_key(email)) is True
+
+    create_user(db, email)
+
+    assert lookup_email(db, email) is not None
+
+
+def test_lookup_racing_with_create_does_not_hide_new_user(db, monkeypatch):
+    email = f"{uuid.uuid4()}@example.com"
+    cache_missing = UserService._cache_missing
+
+    def create_then_cache_missing(key):
+        #the user is created after the lookup missed in postgres but before it writes the negative entry
+        other_db = get_session()
+        create_user(other_db, email)
+        other_db.close()
+        cache_missing(key)
+
+    monkeypatch.setattr(UserService, "_cache_missing", staticmethod(create_then_cache_missing))
+    assert lookup_email(db, email) is None
+    monkeypatch.setattr(UserService, "_cache_missing", staticmethod(cache_missing))
+
+    assert redis_client.get(missing_email_cache_key(email)) is None
+    assert lookup_email(db, email) is not None
+
+
+def test_deleted_user_is_cached_as_missing(db):
+    email = f"{uuid.uuid4()}@example.com"
+    user = create_user(db, email)
+
+    UserService.delete_user(db, user.id)
+
+    assert redis_client.get(missing_email_cache_key(email)) is True
+    assert redis_client.get(missing_user_cache_key(user.id)) is True
+
+
+def test_bulk_push_token_update(db):
+    from app.models.user import User
+    from app.schema.user import BulkPushTokenUpdate
+    from app.services.user_service import segment_count_cache_key
+
+    by_id = create_user(db, f"{uuid.uuid4()}@example.com", push_token=f"id-{uuid.uuid4()}")
+    dead_token = f"dead-{uuid.uuid4()}"
+    by_token = create_user(db, f"{uuid.uuid4()}@example.com", push_token=dead_token)
+    untouched = create_user(db, f"{uuid.uuid4()}@example.com", push_token=f"keep-{uuid.uuid4()}")
+    for user in (by_id, by_token, untouched):
+        UserService.get_user_by_id(db, user.id)
+    redis_client.set(segment_count_cache_key("push"), 3, expire=60)
+
+    result = UserService.bulk_update_push_tokens(db, BulkPushTokenUpdate(updates=[
+        {"user_id": str(by_id.id), "new_token": "rotated"},
+        {"old_token": dead_token, "new_token": None},
+        {"old_token": f"unknown-{uuid.uuid4()}", "new_token": "x"},
+    ]))
+
+    assert result == {"requested": 3, "updated": 2}
+    db.expire_all()
+    assert db.get(User, by_id.id).push_token == "rotated"
+    assert db.get(User, by_token.id).push_token is None
+    assert db.get(User, untouched.id).push_token == untouched.push_token
+    assert redis_client.get(user_cache_key(by_id.id)) is None
+    assert redis_client.get(user_cache_key(by_token.id)) is None
+    assert redis_client.get(user_cache_key(untouched.id)) is not None
+    assert redis_client.get(segment_count_cache_key("push")) is None
+
+
+def assert_segment_counts_fresh(db):
+    from app.schema.user import Segment
+
+    for segment in Segment:
+        assert UserService.get_segment_count(db, segment) == UserService.get_segment_count(db, segment, fresh=True)
+
+
+def test_segment_counts_follow_user_changes(db):
+    from app.schema.user import Segment
+    from app.services.user_service import segment_count_cache_key
+
+    create_user(db, f"{uuid.uuid4()}@example.com", push_token="seed")
+    for segment in Segment:
+        redis_client.delete(segment_count_cache_key(segment.value))
+        UserService.get_segment_count(db, segment)
+
+    user = create_user(db, f"{uuid.uuid4()}@example.com", push_token=f"tok-{uuid.uuid4()}")
+    assert_segment_counts_fresh(db)
+
+    UserService.update_user_preference(db, user.id, UserPreference(email=True, push=False))
+    assert_segment_counts_fresh(db)
+
+    UserService.update_push_token(db, user.id, UserUpdate(push_token=f"tok-{uuid.uuid4()}"))
+    assert_segment_counts_fresh(db)
+
+    UserService.delete_user(db, user.id)
+    assert_segment_counts_fresh(db)
+
+
+def test_segment_pages_until_next_after_is_none(db):
+    from app.schema.user import Segment
+
+    for _ in range(3):
+        create_user(db, f"{uuid.uuid4()}@example.com", push_token=f"tok-{uuid.uuid4()}")
+
+    seen = []
+    after = None
+    while True:
+        rows, after = UserService.get_segment_page(db, Segment.push, after, limit=1)
+        seen.extend(row.user_id for row in rows)
+        if after is None:
+            break
+        assert len(rows) == 1
+
+    assert seen == sorted(seen)
+    assert len(seen) == len(set(seen)) == UserService.get_segment_count(db, Segment.push, fresh=True)